@@ -0,0 +1,135 @@
+import os
+import threading
+import numpy as np
+import requests
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "intfloat/e5-large-v2")
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE")  # e.g. "cuda"; unset = auto
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+TEI_URL = os.getenv("TEI_URL")  # e.g. http://tei:8080 (optional sidecar)
+TEI_BATCH_SIZE = int(os.getenv("TEI_BATCH_SIZE", 32))
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR")  # e.g. ./e5_onnx_int8 (optional quantized export)
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", 32))
+
+
+class TEIEmbeddings(Embeddings):
+    """
+    Embeddings backed by a text-embeddings-inference (TEI) sidecar.
+    Keeps the torch model out of the API workers; TEI does dynamic batching
+    server-side. All calls go through one keep-alive requests.Session.
+    """
+
+    def __init__(self, base_url: str, batch_size: int = TEI_BATCH_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = batch_size
+        self.session = requests.Session()
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            resp = self.session.post(
+                f"{self.base_url}/embed",
+                json={"inputs": texts[i:i + self.batch_size]},
+                timeout=60,
+            )
+            resp.raise_for_status()
+            vectors.extend(resp.json())
+        return vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(list(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text])[0]
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    INT8 ONNX Runtime backend for CPU inference (needs optimum[onnxruntime]).
+    Export + quantize once:
+      optimum-cli export onnx --model intfloat/e5-large-v2 --task feature-extraction e5_onnx/
+    then ORTQuantizer with AutoQuantizationConfig.avx512_vnni(is_static=False),
+    and point ONNX_MODEL_DIR at the quantized output.
+    """
+
+    def __init__(self, model_dir: str, batch_size: int = ONNX_BATCH_SIZE):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, provider="CPUExecutionProvider"
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+
+        # IOBinding fast path for embed_query: fixed [1, 512] input buffers
+        # bound once so per-query inference never reallocates tensors. The
+        # buffers and binding are shared state, so the copy/run/read sequence
+        # is serialized by a lock — embed_query is called from worker threads
+        # (asyncio.to_thread) and overlapping calls would otherwise scribble
+        # over each other's inputs and return corrupted embeddings.
+        import onnxruntime as ort
+        self._session = self.model.model  # underlying ort.InferenceSession
+        self._query_buffers = {
+            inp.name: np.zeros((1, 512), dtype=np.int64)
+            for inp in self._session.get_inputs()
+        }
+        self._io_binding = self._session.io_binding()
+        for name, buf in self._query_buffers.items():
+            self._io_binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(buf))
+        self._io_binding.bind_output(self._session.get_outputs()[0].name)
+        self._io_lock = threading.Lock()
+
+    @staticmethod
+    def _pool(hidden, attention_mask):
+        # e5 pooling: attention-masked mean over tokens, then L2 normalize
+        mask = attention_mask[..., None].astype(hidden.dtype)
+        pooled = (hidden * mask).sum(axis=1) / mask.sum(axis=1)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            enc = self.tokenizer(
+                texts[i:i + self.batch_size],
+                padding=True, truncation=True, max_length=512, return_tensors="np",
+            )
+            hidden = self.model(**enc).last_hidden_state
+            vectors.extend(self._pool(hidden, enc["attention_mask"]).tolist())
+        return vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(list(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        enc = self.tokenizer(
+            text, padding="max_length", truncation=True, max_length=512,
+            return_tensors="np",
+        )
+        with self._io_lock:
+            for name, buf in self._query_buffers.items():
+                np.copyto(buf, enc[name].astype(np.int64) if name in enc else 0)
+            self._session.run_with_iobinding(self._io_binding)
+            hidden = self._io_binding.get_outputs()[0].numpy()
+            return self._pool(hidden, self._query_buffers["attention_mask"])[0].tolist()
+
+
+def get_embeddings() -> Embeddings:
+    """Return the embedding backend selected via env: TEI sidecar, quantized ONNX, or in-process model."""
+    if TEI_URL:
+        return TEIEmbeddings(TEI_URL)
+    if ONNX_MODEL_DIR:
+        return ONNXEmbeddings(ONNX_MODEL_DIR)
+    model_kwargs = {}
+    if EMBEDDING_DEVICE:
+        model_kwargs["device"] = EMBEDDING_DEVICE
+        if EMBEDDING_DEVICE.startswith("cuda"):
+            # FP16 halves memory traffic on the transformer matmuls
+            import torch
+            model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE, "normalize_embeddings": True},
+    )
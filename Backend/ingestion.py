@@ -1,11 +1,14 @@
-import os 
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from langchain_community.document_loaders import PyMuPDFLoader
+from pymongo import MongoClient, InsertOne
+import fitz
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_mongodb.vectorstores import MongoDBAtlasVectorSearch
+from transformers import AutoTokenizer
+from sentence_transformers import SentenceTransformer
+from embeddings import EMBEDDING_MODEL, TEI_URL, get_embeddings
 
 load_dotenv()
 
@@ -13,10 +16,26 @@ MONGODB_URI = os.getenv("MONGODB_URI")
 MONGODB_DB = os.getenv("MONGODB_DB", "brainydocs_db")
 MONGODB_COLLECTION = os.getenv("MONGODB_COLLECTION", "vector_docs")
 DOCS_DIR = os.getenv("DOCS_DIR", "./docs")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))      # chunks per encoder forward pass
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 1000))  # docs per Mongo bulk_write
 
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
-collection = db[MONGODB_COLLECTION]
+# Chunk sizes in *tokens*, kept under e5-large-v2's 512-token window so the
+# encoder never silently truncates chunk tails.
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 450))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 60))
+
+# Compiled once: normalize_text runs per chunk during ingestion
+_WS_RE = re.compile(r"\s+")
+
+# Allowlist filter as a translate table: one C-level pass instead of a second
+# regex scan. Characters outside the allowlist map to a space, exactly like
+# the old [^a-z0-9\s\.\-_:\/] substitution (whitespace is already collapsed
+# to plain spaces by the time the table is applied).
+class _AllowTable(dict):
+    def __missing__(self, codepoint):
+        return " "
+
+_ALLOW_TABLE = _AllowTable({ord(c): c for c in "abcdefghijklmnopqrstuvwxyz0123456789 .-_:/"})
 
 def normalize_text(text: str) -> str:
     """
@@ -26,57 +45,95 @@ def normalize_text(text: str) -> str:
     """
     if not text:
         return ""
-    text = re.sub(r"\s+", " ", text).strip().lower()
-    text = re.sub(r"[^a-z0-9\s\.\-_:\/]", " ", text)
-    return text.strip()
-
-pdf_files = [f for f in os.listdir(DOCS_DIR) if f.endswith(".pdf")]
-if not pdf_files:
-    print(" No PDFs found in directory:", DOCS_DIR)
-    exit(0)
-    
-documents = []
-for pdf in pdf_files:
-    loader = PyMuPDFLoader(os.path.join(DOCS_DIR, pdf))
-    docs = loader.load()
-    for d in docs:
-        d.metadata["pdf_name"] = pdf  
-    documents.extend(docs)
-
-print(f"Loaded {len(documents)} pages from {len(pdf_files)} PDF(s).")
-
-splitter = RecursiveCharacterTextSplitter(
-    chunk_size=2000,
-    chunk_overlap=400,
-    separators=["\n## ", "\n#", "\n\n", "\n", " "],
-    keep_separator=False
-)
-
-split_docs = splitter.split_documents(documents)
-
-for i, doc in enumerate(split_docs):
-    doc.page_content = normalize_text(doc.page_content)
-    
-    pdf_name = doc.metadata.get("pdf_name", "unknown.pdf")
-    page_num = doc.metadata.get("page", None)
-
-    doc.metadata = {
-        "pdf_name": pdf_name,
-        "page_number": page_num if page_num is not None else "unknown"
-    }
-
-
-print(f" Created {len(split_docs)} normalized chunks for embedding.")
-
-embedding = HuggingFaceEmbeddings(model_name="intfloat/e5-large-v2")
-
-print(" Uploading embeddings to MongoDB Atlas Vector Search...")
-
-vector_store = MongoDBAtlasVectorSearch.from_documents(
-    documents=split_docs,
-    embedding=embedding,
-    collection=collection,
-    index_name="vector_index"
-)
-
-print(" All normalized chunks uploaded successfully.")
\ No newline at end of file
+    return _WS_RE.sub(" ", text).strip().lower().translate(_ALLOW_TABLE).strip()
+
+def load_pdf(path: str) -> list:
+    """Load one PDF into per-page Documents, keeping only the metadata we store."""
+    pdf = os.path.basename(path)
+    with fitz.open(path) as doc:
+        return [
+            Document(
+                page_content=page.get_text("text"),
+                metadata={"pdf_name": pdf, "page_number": i},
+            )
+            for i, page in enumerate(doc)
+        ]
+
+def main():
+    # Mongo connection lives here (not module scope) so the worker processes
+    # spawned for PDF parsing don't each open a connection on import.
+    # zstd compression matters here: each doc carries a 1024-float vector.
+    client = MongoClient(MONGODB_URI, compressors="zstd,snappy",
+                         retryWrites=True, appname="brainydocs-ingest")
+    db = client[MONGODB_DB]
+    collection = db[MONGODB_COLLECTION]
+
+    pdf_files = [f for f in os.listdir(DOCS_DIR) if f.endswith(".pdf")]
+    if not pdf_files:
+        print(" No PDFs found in directory:", DOCS_DIR)
+        exit(0)
+
+    # PyMuPDF parsing is CPU-bound: fan PDFs out across processes
+    paths = [os.path.join(DOCS_DIR, pdf) for pdf in pdf_files]
+    documents = []
+    with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as ex:
+        for docs in ex.map(load_pdf, paths):
+            documents.extend(docs)
+
+    print(f"Loaded {len(documents)} pages from {len(pdf_files)} PDF(s).")
+
+    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        AutoTokenizer.from_pretrained(EMBEDDING_MODEL),
+        chunk_size=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
+        separators=["\n## ", "\n#", "\n\n", "\n", " "],
+        keep_separator=False
+    )
+
+    split_docs = splitter.split_documents(documents)
+
+    # Metadata is already {pdf_name, page_number}; only the text needs normalizing.
+    for doc in split_docs:
+        doc.page_content = normalize_text(doc.page_content)
+
+    print(f" Created {len(split_docs)} normalized chunks for embedding.")
+
+    if TEI_URL:
+        print(f" Encoding chunks via TEI sidecar at {TEI_URL}...")
+        vectors = get_embeddings().embed_documents([d.page_content for d in split_docs])
+    else:
+        model = SentenceTransformer(EMBEDDING_MODEL)
+        if model.device.type == "cuda":
+            model.half()
+
+        print(f" Encoding chunks in batches of {EMBED_BATCH_SIZE} on {model.device}...")
+
+        vectors = model.encode(
+            [d.page_content for d in split_docs],
+            batch_size=EMBED_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=True,
+        ).tolist()
+
+    # Same document shape MongoDBAtlasVectorSearch expects: text + embedding,
+    # with metadata keys flattened to the top level.
+    docs_to_insert = [
+        {"text": d.page_content, "embedding": v, **d.metadata}
+        for d, v in zip(split_docs, vectors)
+    ]
+
+    print(" Uploading embeddings to MongoDB Atlas Vector Search...")
+
+    # ordered=False lets the server parallelize the batch and keep going past
+    # individual failures instead of serializing inserts.
+    for i in range(0, len(docs_to_insert), INSERT_BATCH_SIZE):
+        collection.bulk_write(
+            [InsertOne(d) for d in docs_to_insert[i:i + INSERT_BATCH_SIZE]],
+            ordered=False,
+        )
+
+    print(" All normalized chunks uploaded successfully.")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
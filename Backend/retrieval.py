@@ -1,22 +1,34 @@
 import os
 import re
+import json
 import time
+import asyncio
+import hashlib
+import threading
+from functools import lru_cache
 from uuid import uuid4
 from datetime import datetime
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, Request
+import numpy as np
+from redis import asyncio as aioredis
+from cachetools import TTLCache
+from fastapi import FastAPI, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from motor.motor_asyncio import AsyncIOMotorClient
 import bcrypt
 import jwt
+from argon2 import PasswordHasher
+from bson import ObjectId
 from google.oauth2 import id_token
 from google.auth.transport import requests as grequests
 
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_mongodb.vectorstores import MongoDBAtlasVectorSearch
+from embeddings import get_embeddings
 from langchain_groq import ChatGroq
-from langchain.chains import ConversationalRetrievalChain
+from langchain_core.output_parsers import StrOutputParser
 from langchain.prompts import PromptTemplate
 
 load_dotenv()
@@ -33,10 +45,37 @@ JWT_EXP_SECONDS = int(os.getenv("JWT_EXP_SECONDS", 7 * 24 * 3600))
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 
+# One transport per worker thread for Google token verification: the
+# underlying requests.Session keeps the connection to oauth2.googleapis.com
+# alive but is not thread-safe, and verification runs via asyncio.to_thread.
+_google_tls = threading.local()
+
+def verify_google_token(token: str) -> dict:
+    """Blocking: verifies the Google ID token (HTTPS cert fetch). Run in a thread."""
+    req = getattr(_google_tls, "request", None)
+    if req is None:
+        req = _google_tls.request = grequests.Request()
+    return id_token.verify_oauth2_token(token, req, GOOGLE_CLIENT_ID)
+
 # Summarization/trimming thresholds (configurable via env)
 MAX_SESSION_MESSAGES = int(os.getenv("MAX_SESSION_MESSAGES", 15))   # when to summarize
 TRIM_TO_MESSAGES = int(os.getenv("TRIM_TO_MESSAGES", 5))           # keep last n messages after summarization
 MAX_USER_SESSIONS = int(os.getenv("MAX_USER_SESSIONS", 10))        # keep top n recent sessions
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", 10))  # messages fed back to the chain
+
+# Optional Redis cache for answers + query embeddings
+REDIS_URL = os.getenv("REDIS_URL")
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 3600))        # seconds
+
+# Semantic response cache: near-duplicate queries within a session reuse the
+# cached answer instead of re-running retrieval + the LLM.
+# Threshold is on Atlas $vectorSearch's *normalized* cosine score,
+# (1 + cosine) / 2 — so 0.97 means raw cosine >= 0.94. e5 embeddings compress
+# similarities into a narrow high band, so anything much lower starts matching
+# distinct-but-related queries ("chapter 1" vs "chapter 2").
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.97))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 3600))    # seconds
+SEMANTIC_CACHE_INDEX = os.getenv("SEMANTIC_CACHE_INDEX", "response_cache_index")
 
 app = FastAPI(title="BrainyDocs RAG Backend (retrieval)")
 
@@ -49,11 +88,27 @@ app.add_middleware(
 )
 
 # ----- MongoDB + Collections -----
-client = MongoClient(MONGODB_URI)
+# Shared client options: bounded pool, wire compression (embedding docs
+# compress well), retryable writes, and an appname for Atlas profiling.
+MONGO_CLIENT_KWARGS = dict(
+    maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", 200)),
+    minPoolSize=int(os.getenv("MONGODB_MIN_POOL_SIZE", 10)),
+    compressors="zstd,snappy",
+    retryWrites=True,
+    w="majority",
+    serverSelectionTimeoutMS=5000,
+    socketTimeoutMS=20000,
+    appname="brainydocs",
+)
+
+# Async client for the request path: Mongo I/O no longer blocks the event loop
+client = AsyncIOMotorClient(MONGODB_URI, **MONGO_CLIENT_KWARGS)
 db = client[MONGODB_DB]
 
-# Vector store uses the vector docs collection (unchanged)
-collection = db[MONGODB_COLLECTION]
+# The LangChain vector store needs a sync pymongo collection; its searches
+# run under asyncio.to_thread, so they never block the loop.
+sync_client = MongoClient(MONGODB_URI, **MONGO_CLIENT_KWARGS)
+collection = sync_client[MONGODB_DB][MONGODB_COLLECTION]
 
 # Session-based chat storage
 chat_history_col = db["chat_history"]                   # stores one doc per chat session (session_id: uuid hex)
@@ -62,8 +117,45 @@ user_chat_summary_col = db["user_chat_summary"]         # stores recent_chats li
 # Keep users collection for auth
 users_col = db["users"]
 
+# Semantic answer cache (TTL'd; vector index on "embedding")
+response_cache_col = db["response_cache"]
+
+# Redis is optional: without REDIS_URL every request just runs the full
+# pipeline. Async client so cache hits/misses never block the event loop.
+redis_client = aioredis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Point-lookup indexes so auth and session queries stay O(log N) as data grows.
+# Best-effort: a failure (e.g. pre-existing duplicates) shouldn't stop the app.
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await users_col.create_index([("email", 1), ("provider", 1)], unique=True)
+        await chat_history_col.create_index([("user_id", 1), ("session_id", 1)], unique=True)
+        await user_chat_summary_col.create_index("user_id", unique=True)
+        await response_cache_col.create_index("ts", expireAfterSeconds=SEMANTIC_CACHE_TTL)
+    except Exception as e:
+        print(f" Index creation failed (continuing): {e}")
+
+    # Atlas vector index for the semantic cache; needs Atlas 7.0+ and may
+    # already exist, so treat failure as "create it from the Atlas UI".
+    try:
+        from pymongo.operations import SearchIndexModel
+        await response_cache_col.create_search_index(
+            SearchIndexModel(
+                definition={"fields": [
+                    {"type": "vector", "path": "embedding", "numDimensions": 1024, "similarity": "cosine"},
+                    {"type": "filter", "path": "user_id"},
+                    {"type": "filter", "path": "session_id"},
+                ]},
+                name=SEMANTIC_CACHE_INDEX,
+                type="vectorSearch",
+            )
+        )
+    except Exception as e:
+        print(f" response_cache vector index not created (continuing): {e}")
+
 # ----- Embeddings, Vectorstore, LLM, Chain (loaded once) -----
-embedding = HuggingFaceEmbeddings(model_name="intfloat/e5-large-v2")
+embedding = get_embeddings()
 
 vector_store = MongoDBAtlasVectorSearch(
     embedding=embedding,
@@ -100,6 +192,12 @@ Always answer using proper Markdown formatting:
 - Don't use extra newlines or unnecessary spaces
 Ensure the output is clean Markdown.
 
+Use the conversation history only to resolve references in the question
+(e.g. "it", "that step"); facts must still come from the context.
+
+Conversation history (may be empty):
+{history}
+
 Context:
 {context}
 
@@ -109,31 +207,204 @@ User Question:
 Answer:
 """
 
-prompt = PromptTemplate(input_variables=["context", "question"], template=PROMPT_TEMPLATE)
+prompt = PromptTemplate(input_variables=["context", "question", "history"],
+                        template=PROMPT_TEMPLATE)
+
+# Retrieval knobs.
+# MMR: pick k diverse chunks out of fetch_k candidates, so raising recall
+# doesn't stuff the prompt with near-duplicate chunks of the same page.
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", 5))
+RETRIEVER_FETCH_K = int(os.getenv("RETRIEVER_FETCH_K", 20))
+RETRIEVER_LAMBDA = float(os.getenv("RETRIEVER_LAMBDA", 0.5))
+# Atlas $vectorSearch scans fetch_k * oversampling_factor candidates; the
+# library default of 10 over-scans for a corpus this size.
+RETRIEVER_OVERSAMPLING = int(os.getenv("RETRIEVER_OVERSAMPLING", 5))
+
+# One LLM call per turn: retrieval runs on the query vector we already
+# computed for the semantic cache, and recent history goes straight into the
+# prompt instead of a separate question-rephrasing LLM round-trip (which is
+# what ConversationalRetrievalChain did, doubling Groq latency and cost).
+answer_chain = prompt | llm | StrOutputParser()
+
+def format_docs(docs) -> str:
+    return "\n\n".join(d.page_content for d in docs)
+
+def format_history(pairs) -> str:
+    return "\n".join(f"User: {q}\nAssistant: {a}" for q, a in pairs)
+
+async def retrieve_docs(query_vector: list[float]) -> list:
+    """MMR retrieval from the precomputed query vector (sync pymongo under a thread)."""
+    return await asyncio.to_thread(
+        vector_store.max_marginal_relevance_search_by_vector,
+        query_vector,
+        k=RETRIEVER_K,
+        fetch_k=RETRIEVER_FETCH_K,
+        lambda_mult=RETRIEVER_LAMBDA,
+        oversampling_factor=RETRIEVER_OVERSAMPLING,
+    )
 
-# create retriever + chain once (reuse)
-retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-conversational_chain = ConversationalRetrievalChain.from_llm(
-    llm=llm,
-    retriever=retriever,
-    combine_docs_chain_kwargs={"prompt": prompt},
-    return_source_documents=True,
-)
+def build_sources(docs) -> list[str]:
+    """Deduplicated "name (page n)" labels, retrieval order preserved."""
+    seen = set()
+    sources = []
+    for d in docs:
+        meta = getattr(d, "metadata", {}) or {}
+        source = f"{meta.get('pdf_name', 'unknown.pdf')} (page {meta.get('page_number', 'unknown')})"
+        if source not in seen:
+            seen.add(source)
+            sources.append(source)
+    return sources
+
+@app.on_event("startup")
+async def warmup_models():
+    """Pay the lazy model-load cost at boot instead of inside the first /chat."""
+    # Pin torch before the first forward pass: inference never needs autograd
+    # bookkeeping, and unbounded intra-op threads oversubscribe the CPU once
+    # several uvicorn workers run side by side.
+    try:
+        import torch
+        torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", 4)))
+        torch.set_grad_enabled(False)
+    except Exception as e:
+        print(f" Torch tuning skipped: {e}")
+    try:
+        await asyncio.to_thread(embedding.embed_query, "warmup")
+        await asyncio.to_thread(vector_store.similarity_search, "warmup", 1)
+    except Exception as e:
+        print(f" Warmup failed (continuing): {e}")
+    # One tiny Groq call primes the chain's client (TLS handshake, connection
+    # pool) so the first real /chat doesn't pay for it.
+    try:
+        await answer_chain.ainvoke({"context": "", "question": "warmup", "history": ""})
+    except Exception as e:
+        print(f" Chain warmup failed (continuing): {e}")
 
 # ----- Utilities -----
+_WS_RE = re.compile(r"\s+")
+
+# Same single-pass allowlist table as ingestion: anything outside the
+# allowlist maps to a space, matching the old [^a-z0-9\s\.\-_:\/] regex.
+class _AllowTable(dict):
+    def __missing__(self, codepoint):
+        return " "
+
+_ALLOW_TABLE = _AllowTable({ord(c): c for c in "abcdefghijklmnopqrstuvwxyz0123456789 .-_:/"})
+
+@lru_cache(maxsize=4096)
 def normalize_text(text: str) -> str:
-    """Normalization used for documents (keeps compatibility with ingestion)."""
+    """
+    Normalization used for documents (keeps compatibility with ingestion).
+    Pure function, so repeat queries come straight from the lru_cache.
+    """
     if not text:
         return ""
-    text = re.sub(r"\s+", " ", text).strip().lower()
-    text = re.sub(r"[^a-z0-9\s\.\-_:\/]", " ", text)
-    return text.strip()
+    return _WS_RE.sub(" ", text).strip().lower().translate(_ALLOW_TABLE).strip()
+
+async def embed_query_cached(text: str) -> list[float]:
+    """
+    embed_query with a Redis cache keyed on the normalized text (float32
+    bytes). Cache I/O is async; only the model forward pass goes to a thread.
+    """
+    if redis_client is None:
+        return await asyncio.to_thread(embedding.embed_query, text)
+    key = "emb:" + hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    try:
+        cached = await redis_client.get(key)
+        if cached:
+            return np.frombuffer(cached, dtype=np.float32).tolist()
+    except Exception as e:
+        print(f" Redis embedding cache read failed: {e}")
+    vec = await asyncio.to_thread(embedding.embed_query, text)
+    try:
+        await redis_client.setex(key, ANSWER_CACHE_TTL, np.asarray(vec, dtype=np.float32).tobytes())
+    except Exception as e:
+        print(f" Redis embedding cache write failed: {e}")
+    return vec
+
+# Argon2 for new hashes (cheaper per unit of security than bcrypt cost 12);
+# bcrypt is kept only to verify hashes created before the switch. Parameters
+# are env-tunable so the per-auth CPU budget is explicit.
+password_hasher = PasswordHasher(
+    time_cost=int(os.getenv("ARGON2_TIME_COST", 2)),
+    memory_cost=int(os.getenv("ARGON2_MEMORY_COST", 64 * 1024)),
+    parallelism=int(os.getenv("ARGON2_PARALLELISM", 1)),
+)
+
+def build_history_pairs(messages: list) -> list:
+    """
+    Rebuild [query, answer] pairs from a message list. Fallback for sessions
+    created before chat_history_pairs existed as a derived field; any session
+    written to since the migration carries the field and skips this.
+    """
+    pairs = []
+    last_user = None
+    for m in messages:
+        if m.get("role") == "user":
+            last_user = m.get("query")
+        elif m.get("role") == "assistant" and last_user is not None:
+            pairs.append([last_user, m.get("answer", "")])
+            last_user = None
+    return pairs
+
+def history_pairs_from(session: dict) -> list:
+    """Recent history as (query, answer) tuples from a projected session doc."""
+    if "chat_history_pairs" in session:
+        return [tuple(p) for p in session["chat_history_pairs"]]
+    # Pre-migration session: no derived field yet, rebuild from the messages
+    # tail so older conversations don't silently lose their history.
+    return [tuple(p) for p in build_history_pairs(session.get("messages") or [])]
+
+async def push_recent_chat(user_id: str, session_id: str, title: str):
+    """
+    Move a session to the front of the user's sidebar list (top N kept).
+    The $pull + $push pair is pipelined as one ordered bulk_write round-trip.
+    """
+    await user_chat_summary_col.bulk_write([
+        UpdateOne({"user_id": user_id},
+                  {"$pull": {"recent_chats": {"session_id": session_id}}}),
+        UpdateOne({"user_id": user_id},
+                  {"$push": {"recent_chats": {
+                      "$each": [{"session_id": session_id, "title": title}],
+                      "$position": 0,
+                      "$slice": MAX_USER_SESSIONS}}},
+                  upsert=True),
+    ], ordered=True)
+
+async def semantic_cache_lookup(user_id: str, session_id: str, query_vector: list[float]):
+    """
+    Return the cached {answer, sources} for the most similar recent query in
+    this session, or None if nothing clears SEMANTIC_CACHE_THRESHOLD.
+    """
+    try:
+        cursor = response_cache_col.aggregate([
+            {"$vectorSearch": {
+                "index": SEMANTIC_CACHE_INDEX,
+                "path": "embedding",
+                "queryVector": query_vector,
+                "numCandidates": 20,
+                "limit": 1,
+                "filter": {"user_id": user_id, "session_id": session_id},
+            }},
+            {"$project": {"_id": 0, "answer": 1, "sources": 1,
+                          "score": {"$meta": "vectorSearchScore"}}},
+        ])
+        async for hit in cursor:
+            if hit.get("score", 0) >= SEMANTIC_CACHE_THRESHOLD:
+                return hit
+    except Exception as e:
+        print(f" Semantic cache lookup failed: {e}")
+    return None
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return password_hasher.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    if hashed.startswith(("$2a$", "$2b$", "$2y$")):  # legacy bcrypt user
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    try:
+        return password_hasher.verify(hashed, password)
+    except Exception:
+        return False
 
 def create_jwt_token(user_id: str, email: str):
     now = int(time.time())
@@ -148,71 +419,49 @@ def decode_jwt_token(token: str):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def get_current_user(request: Request):
+# In-process auth cache: token digest -> user dict. Saves an HMAC verify and
+# a Mongo round-trip on every authenticated request. Plain dict ops are
+# GIL-atomic, so no locking is needed on the single event loop.
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 60))
+_user_cache = TTLCache(maxsize=10000, ttl=AUTH_CACHE_TTL)
+
+async def get_current_user(request: Request):
     auth_header = request.headers.get("Authorization") or request.headers.get("authorization")
     if not auth_header:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
-    scheme, _, token = auth_header.partition(" ")
-    if scheme.lower() != "bearer" or not token:
+    # Prefix check instead of partition + lower(): no intermediate strings
+    # on the per-request hot path. Clients send "Bearer " or "bearer ".
+    if not auth_header.startswith(("Bearer ", "bearer ")):
+        raise HTTPException(status_code=401, detail="Invalid auth format")
+    token = auth_header[7:]
+    if not token:
         raise HTTPException(status_code=401, detail="Invalid auth format")
+    cache_key = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+    cached = _user_cache.get(cache_key)
+    if cached is not None:
+        return cached
     payload = decode_jwt_token(token)
     user_id = payload.get("sub")
-    user = users_col.find_one({"_id": __import__("bson").ObjectId(user_id)}) if user_id else None
+    user = await users_col.find_one({"_id": ObjectId(user_id)}) if user_id else None
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     user.pop("password", None)
     user["_id"] = str(user["_id"])
+    # Never cache past the token's own expiry
+    if payload.get("exp", 0) - int(time.time()) >= AUTH_CACHE_TTL:
+        _user_cache[cache_key] = user
     return user
 
-# Robust summarization helper: tries different invocation styles for llm to be compatible.
-def summarization_call(prompt_text: str) -> str:
+async def summarization_call(prompt_text: str) -> str:
     """
-    Attempts to call the LLM to produce a summary. Tries a few invocation patterns and returns
-    the first successful response string. If all fail, returns an empty string.
+    Calls the LLM to produce a summary via the Runnable API (the one path
+    ChatGroq actually supports). Returns the AIMessage content, or "" on a
+    string-typed response edge case.
     """
-    try:
-        # Many LangChain LLMs support __call__ as a convenience
-        resp = llm(prompt_text)
-        # resp might be a string or an object
-        if isinstance(resp, str):
-            return resp
-        # some wrappers return object with 'generations' or 'content'
-        if hasattr(resp, "generations"):
-            gens = getattr(resp, "generations")
-            if gens and isinstance(gens, list) and len(gens) > 0:
-                if isinstance(gens[0], list) and len(gens[0]) > 0 and hasattr(gens[0][0], "text"):
-                    return gens[0][0].text
-        if hasattr(resp, "content"):
-            return resp.content
-    except Exception:
-        pass
-
-    # Try generate()
-    try:
-        resp2 = llm.generate([prompt_text])
-        # resp2 may have a .generations structure
-        if hasattr(resp2, "generations"):
-            gens = resp2.generations
-            if gens and len(gens) > 0 and len(gens[0]) > 0 and hasattr(gens[0][0], "text"):
-                return gens[0][0].text
-    except Exception:
-        pass
-
-    # Try invoke (used in examples)
-    try:
-        if hasattr(llm, "invoke"):
-            inv = llm.invoke(prompt_text)
-            if isinstance(inv, str):
-                return inv
-            if hasattr(inv, "content"):
-                return inv.content
-    except Exception:
-        pass
+    msg = await llm.ainvoke(prompt_text)
+    return msg if isinstance(msg, str) else (getattr(msg, "content", "") or "")
 
-    # fallback
-    return ""
-
-def generate_title_from_conversation(question: str, answer: str) -> str:
+async def generate_title_from_conversation(question: str, answer: str) -> str:
     """
     Generate a short descriptive title (<= 8 words) for a chat session.
     Uses the same LLM path as summarization_call to stay compatible.
@@ -226,7 +475,7 @@ def generate_title_from_conversation(question: str, answer: str) -> str:
         "Title:"
     )
     try:
-        title_text = summarization_call(prompt_text).strip()
+        title_text = (await summarization_call(prompt_text)).strip()
         title_text = title_text.replace('"', '').replace("'", "").strip()
         if not title_text:
             return "New Chat"
@@ -236,6 +485,75 @@ def generate_title_from_conversation(question: str, answer: str) -> str:
     except Exception:
         return "New Chat"
 
+async def _gen_title_and_update(user_id: str, session_id: str, query: str, answer: str):
+    """Background task: name an untitled session from its first exchange."""
+    try:
+        auto_title = await generate_title_from_conversation(query, answer)
+        if not auto_title:
+            return
+        res = await chat_history_col.update_one(
+            {"user_id": user_id, "session_id": session_id, "title": None},
+            {"$set": {"title": auto_title}}
+        )
+        if res.modified_count:
+            await push_recent_chat(user_id, session_id, auto_title)
+    except Exception as e:
+        print(f" Auto title generation failed for session {session_id}: {e}")
+
+async def _maybe_summarize(user_id: str, session_id: str):
+    """Background task: summarize and trim sessions that exceed the threshold (best-effort)."""
+    # Count server-side first: most turns are under the threshold and should
+    # cost a few bytes, not the whole messages array.
+    counts = await chat_history_col.aggregate([
+        {"$match": {"user_id": user_id, "session_id": session_id}},
+        {"$project": {"_id": 0, "msg_count": {"$size": "$messages"}}},
+    ]).to_list(1)
+    if not counts or counts[0]["msg_count"] <= MAX_SESSION_MESSAGES:
+        return
+
+    session = await chat_history_col.find_one(
+        {"user_id": user_id, "session_id": session_id},
+        {"_id": 0, "messages": 1}
+    )
+    if not session:
+        return
+
+    # Build human-friendly Q/A text from messages
+    qa_lines = []
+    for m in session["messages"]:
+        if m.get("role") == "user":
+            qa_lines.append(f"Q: {m.get('query')}")
+        elif m.get("role") == "assistant":
+            qa_lines.append(f"A: {m.get('answer')}")
+    qa_text = "\n\n".join(qa_lines)
+
+    summary_prompt = (
+        "Summarize the following conversation in a concise, technical paragraph (<= 120 words). "
+        "Focus on the key topics discussed, decisions, and important referenced documents.\n\n"
+        f"{qa_text}\n\nSummary:"
+    )
+
+    try:
+        summary_text = (await summarization_call(summary_prompt)).strip()
+        if summary_text:
+            # Store summary and trim server-side with a pipeline update: the
+            # $slice runs on the document in place, so the trimmed arrays are
+            # never shipped back over the wire. Messages pushed between our
+            # read and this write stay in the tail instead of being clobbered.
+            trim_pairs = TRIM_TO_MESSAGES // 2  # one pair per user+assistant turn
+            trimmed = {
+                "messages": {"$slice": ["$messages", -TRIM_TO_MESSAGES]} if TRIM_TO_MESSAGES > 0 else [],
+                "chat_history_pairs": {"$slice": ["$chat_history_pairs", -trim_pairs]} if trim_pairs > 0 else [],
+            }
+            await chat_history_col.update_one(
+                {"user_id": user_id, "session_id": session_id},
+                [{"$set": {"summary": summary_text,
+                           "updated_at": int(time.time()), **trimmed}}]
+            )
+    except Exception as e:
+        # non-fatal: log and continue
+        print(f"Warning: summarization failed for session {session_id}: {e}")
+
 # ----- Pydantic models -----
 class SignUpRequest(BaseModel):
     email: EmailStr
@@ -260,12 +578,13 @@ class RenameRequest(BaseModel):
 
 # ----- Auth endpoints (kept) -----
 @app.post("/signup")
-def signup(req: SignUpRequest):
+async def signup(req: SignUpRequest):
     email = req.email.lower().strip()
-    if users_col.find_one({"email": email, "provider": "local"}):
+    if await users_col.find_one({"email": email, "provider": "local"}):
         raise HTTPException(status_code=400, detail="User already exists")
 
-    hashed = hash_password(req.password)
+    # Hashing deliberately burns ~100ms of CPU; keep it off the event loop
+    hashed = await asyncio.to_thread(hash_password, req.password)
     user_doc = {
         "email": email,
         "password": hashed,
@@ -273,16 +592,16 @@ def signup(req: SignUpRequest):
         "provider": "local",
         "created_at": int(time.time())
     }
-    res = users_col.insert_one(user_doc)
+    res = await users_col.insert_one(user_doc)
     token = create_jwt_token(str(res.inserted_id), email)
     return {"access_token": token, "token_type": "bearer",
             "user": {"email": email, "name": user_doc["name"], "id": str(res.inserted_id)}}
 
 @app.post("/login")
-def login(req: LoginRequest):
+async def login(req: LoginRequest):
     email = req.email.lower().strip()
-    user = users_col.find_one({"email": email, "provider": "local"})
-    if not user or not verify_password(req.password, user["password"]):
+    user = await users_col.find_one({"email": email, "provider": "local"})
+    if not user or not await asyncio.to_thread(verify_password, req.password, user["password"]):
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
     token = create_jwt_token(str(user["_id"]), email)
@@ -290,20 +609,21 @@ def login(req: LoginRequest):
             "user": {"email": email, "name": user.get("name", ""), "id": str(user["_id"])}}
 
 @app.post("/google")
-def auth_google(req: GoogleAuthRequest):
+async def auth_google(req: GoogleAuthRequest):
     try:
-        idinfo = id_token.verify_oauth2_token(req.id_token, grequests.Request(), GOOGLE_CLIENT_ID)
+        # Blocking HTTPS round-trip to Google's cert endpoint: keep it off the loop
+        idinfo = await asyncio.to_thread(verify_google_token, req.id_token)
         userid = idinfo["sub"]
         email = idinfo.get("email")
         name = idinfo.get("name", email.split("@")[0])
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid Google token: {e}")
 
-    user = users_col.find_one({"email": email, "provider": "google"})
+    user = await users_col.find_one({"email": email, "provider": "google"})
     if not user:
         user_doc = {"email": email, "name": name, "provider": "google",
                     "google_sub": userid, "created_at": int(time.time())}
-        res = users_col.insert_one(user_doc)
+        res = await users_col.insert_one(user_doc)
         user_id = str(res.inserted_id)
     else:
         user_id = str(user["_id"])
@@ -314,7 +634,7 @@ def auth_google(req: GoogleAuthRequest):
 
 # ----- Session endpoints -----
 @app.post("/new_session")
-def new_session(req: CreateSessionRequest | None = None, user=Depends(get_current_user)):
+async def new_session(req: CreateSessionRequest | None = None, user=Depends(get_current_user)):
     """
     Create a new session for the user. Returns session_id.
     """
@@ -328,25 +648,18 @@ def new_session(req: CreateSessionRequest | None = None, user=Depends(get_curren
         "created_at": now,
         "updated_at": now,
         "summary": None,
-        "messages": []  # each message: { role: "user"|"assistant", query/answer, sources?, timestamp }
+        "messages": [],  # each message: { role: "user"|"assistant", query/answer, sources?, timestamp }
+        "chat_history_pairs": []  # derived [query, answer] pairs kept in sync on each turn
     }
-    chat_history_col.insert_one(session_doc)
+    await chat_history_col.insert_one(session_doc)
 
     # add to user's recent chats front (maintain top N)
-    user_chat_summary_col.update_one(
-        {"user_id": user_id},
-        {"$pull": {"recent_chats": {"session_id": session_id}}},
-    )
-    user_chat_summary_col.update_one(
-        {"user_id": user_id},
-        {"$push": {"recent_chats": {"$each": [{"session_id": session_id, "title": session_doc.get("title") or ""}], "$position": 0, "$slice": MAX_USER_SESSIONS}}},
-        upsert=True
-    )
+    await push_recent_chat(user_id, session_id, session_doc.get("title") or "")
 
     return {"session_id": session_id, "created_at": now, "title": session_doc.get("title")}
 
 @app.post("/chat/{session_id}")
-def chat_with_session(session_id: str, req: ChatRequest, user=Depends(get_current_user)):
+async def chat_with_session(session_id: str, req: ChatRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     """
     Post a user query to a specific session. Uses only this session's messages as context.
     If session_id does not exist, returns 404.
@@ -357,149 +670,196 @@ def chat_with_session(session_id: str, req: ChatRequest, user=Depends(get_curren
 
     user_id = str(user["_id"])
 
-    # Load session (session_id is stored as a field, not _id)
-    session = chat_history_col.find_one({"user_id": user_id, "session_id": session_id})
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-
     now = int(time.time())
 
-    # Append user message
+    # Append the user message and load the post-push context in one atomic
+    # round-trip (session_id is stored as a field, not _id); a None result
+    # doubles as the 404 check. The derived chat_history_pairs field is kept
+    # in sync on every assistant push, so no per-turn rebuild from messages.
     user_msg = {"role": "user", "query": query_raw, "timestamp": now}
-    chat_history_col.update_one(
+    session = await chat_history_col.find_one_and_update(
         {"user_id": user_id, "session_id": session_id},
-        {"$push": {"messages": user_msg}, "$set": {"updated_at": now}}
+        {"$push": {"messages": user_msg}, "$set": {"updated_at": now}},
+        projection={"_id": 0, "title": 1,
+                    "chat_history_pairs": {"$slice": -(MAX_HISTORY_MESSAGES // 2)},
+                    "messages": {"$slice": -MAX_HISTORY_MESSAGES}},
+        return_document=ReturnDocument.AFTER,
     )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    chat_history_pairs = history_pairs_from(session)
 
-    # Reload session to include appended user msg
-    session = chat_history_col.find_one({"user_id": user_id, "session_id": session_id})
-    messages = session.get("messages", [])
-
-    # Build chat history pairs [(q,a), ...] from session messages
-    chat_history_pairs = []
-    last_user = None
-    for m in messages:
-        if m.get("role") == "user":
-            last_user = m.get("query")
-        elif m.get("role") == "assistant" and last_user is not None:
-            chat_history_pairs.append((last_user, m.get("answer", "")))
-            last_user = None
-
-    # Run RAG chain using **only this session** chat history
-    chain_input = {"question": query_raw, "chat_history": chat_history_pairs}
-    try:
-        result = conversational_chain(chain_input)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error running retrieval chain: {str(e)}")
-
-    answer = result.get("answer") or result.get("result") or ""
-    docs = result.get("source_documents", []) or []
-
-    # Build sources
+    # Answer cache: only for history-free turns (conversational context changes answers)
+    cache_key = None
+    answer = None
     sources = []
-    for d in docs:
-        meta = getattr(d, "metadata", {}) or {}
-        pdf_name = meta.get("pdf_name", "unknown.pdf")
-        page_number = meta.get("page_number", "unknown")
-        sources.append(f"{pdf_name} (page {page_number})")
+    if redis_client is not None and not chat_history_pairs:
+        cache_key = "ans:" + hashlib.sha256(f"{user_id}:{normalize_text(query_raw)}".encode("utf-8")).hexdigest()
+        try:
+            cached = await redis_client.get(cache_key)
+            if cached:
+                payload = json.loads(cached)
+                answer = payload.get("answer", "")
+                sources = payload.get("sources", [])
+        except Exception as e:
+            print(f" Redis answer cache read failed: {e}")
+
+    # Semantic cache: a near-duplicate query answered recently in this session
+    # skips retrieval and generation entirely. Gated on history-free turns for
+    # the same reason as the exact-match cache above — the same question can
+    # have a different answer mid-conversation. The query is embedded once
+    # here (through the Redis-backed embedding cache) for the lookup and the
+    # retrieval below.
+    query_vector = None
+    if answer is None:
+        query_vector = await embed_query_cached(query_raw)
+        if not chat_history_pairs:
+            hit = await semantic_cache_lookup(user_id, session_id, query_vector)
+            if hit:
+                answer = hit.get("answer", "")
+                sources = hit.get("sources", [])
+
+    if answer is None:
+        # Retrieve on the vector embedded above, then one LLM call with
+        # **only this session's** history inlined in the prompt.
+        try:
+            docs = await retrieve_docs(query_vector)
+            answer = await answer_chain.ainvoke({
+                "context": format_docs(docs),
+                "question": query_raw,
+                "history": format_history(chat_history_pairs),
+            })
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error running retrieval chain: {str(e)}")
+
+        sources = build_sources(docs)
+
+        if cache_key is not None:
+            try:
+                await redis_client.setex(cache_key, ANSWER_CACHE_TTL,
+                                         json.dumps({"answer": answer, "sources": sources}))
+            except Exception as e:
+                print(f" Redis answer cache write failed: {e}")
+
+        if query_vector is not None and not chat_history_pairs:
+            try:
+                await response_cache_col.insert_one({
+                    "user_id": user_id, "session_id": session_id,
+                    "query": query_raw, "embedding": query_vector,
+                    "answer": answer, "sources": sources,
+                    "ts": datetime.utcnow(),
+                })
+            except Exception as e:
+                print(f" Semantic cache write failed: {e}")
 
     # Save assistant reply
     assistant_msg = {
         "role": "assistant",
         "answer": answer,
-        "sources": list(dict.fromkeys(sources)),  # deduplicate preserving order
+        "sources": sources,  # already deduplicated, order preserved
         "timestamp": int(time.time())
     }
-    chat_history_col.update_one(
+    await chat_history_col.update_one(
         {"user_id": user_id, "session_id": session_id},
-        {"$push": {"messages": assistant_msg}, "$set": {"updated_at": int(time.time())}}
+        {"$push": {"messages": assistant_msg,
+                   "chat_history_pairs": {"$each": [[query_raw, answer]],
+                                          "$slice": -(MAX_HISTORY_MESSAGES // 2)}},
+         "$set": {"updated_at": int(time.time())}}
     )
 
-    # --- Auto-generate a descriptive title for this session (like ChatGPT) ---
-    auto_title = None
-    if not session.get("title"):  # Only set title if it's still None
-        try:
-            auto_title = generate_title_from_conversation(query_raw, answer)
-            if auto_title:
-                chat_history_col.update_one(
-                    {"user_id": user_id, "session_id": session_id},
-                    {"$set": {"title": auto_title}}
-                )
-                # Also update sidebar recent chats
-                user_chat_summary_col.update_one(
-                    {"user_id": user_id},
-                    {"$pull": {"recent_chats": {"session_id": session_id}}}
-                )
-                user_chat_summary_col.update_one(
-                    {"user_id": user_id},
-                    {"$push": {
-                        "recent_chats": {
-                            "$each": [{"session_id": session_id, "title": auto_title}],
-                            "$position": 0,
-                            "$slice": MAX_USER_SESSIONS
-                        }
-                    }},
-                    upsert=True
-                )
-        except Exception as e:
-            print(f" Auto title generation failed for session {session_id}: {e}")
-
-    # Update user's recent_chats (move to front and update title if available)
-    # Use the freshest known title (auto_title if just created, else session.title)
-    current_title = (auto_title or session.get("title") or "")
-    user_chat_summary_col.update_one(
-        {"user_id": user_id},
-        {"$pull": {"recent_chats": {"session_id": session_id}}},
-    )
-    user_chat_summary_col.update_one(
-        {"user_id": user_id},
-        {"$push": {
-            "recent_chats": {
-                "$each": [{"session_id": session_id, "title": current_title}],
-                "$position": 0,
-                "$slice": MAX_USER_SESSIONS
-            }
-        }},
-        upsert=True
+    # Sidebar bump with whatever title we know now; the background title task
+    # refreshes it again if it generates one.
+    await push_recent_chat(user_id, session_id, session.get("title") or "")
+
+    # Title generation and summarize/trim each cost an extra Groq call the
+    # client never sees in-response, so they run after the reply is sent.
+    if not session.get("title"):
+        background_tasks.add_task(_gen_title_and_update, user_id, session_id, query_raw, answer)
+    background_tasks.add_task(_maybe_summarize, user_id, session_id)
+
+    return {"answer": answer, "sources": sources, "session_id": session_id}
+
+@app.post("/chat/stream/{session_id}")
+async def chat_stream(session_id: str, req: ChatRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+    """
+    SSE variant of /chat: streams answer deltas as they arrive
+    ("data: {delta}" events) and persists the full assistant message at
+    end-of-stream, closing with a {done, sources} event.
+    """
+    query_raw = req.query.strip()
+    if not query_raw:
+        raise HTTPException(status_code=400, detail="Empty query")
+
+    user_id = str(user["_id"])
+    now = int(time.time())
+
+    user_msg = {"role": "user", "query": query_raw, "timestamp": now}
+    session = await chat_history_col.find_one_and_update(
+        {"user_id": user_id, "session_id": session_id},
+        {"$push": {"messages": user_msg}, "$set": {"updated_at": now}},
+        projection={"_id": 0, "title": 1,
+                    "chat_history_pairs": {"$slice": -(MAX_HISTORY_MESSAGES // 2)},
+                    "messages": {"$slice": -MAX_HISTORY_MESSAGES}},
+        return_document=ReturnDocument.AFTER,
     )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    chat_history_pairs = history_pairs_from(session)
 
-    # --- Summarize & Trim if session exceeds threshold ---
-    # Note: summarization is best-effort; failures won't break the chat flow.
-    session = chat_history_col.find_one({"user_id": user_id, "session_id": session_id})  # reload
-    total_msgs = len(session.get("messages", []))
-    if total_msgs > MAX_SESSION_MESSAGES:
-        # Build human-friendly Q/A text from messages
-        qa_lines = []
-        for m in session["messages"]:
-            if m.get("role") == "user":
-                qa_lines.append(f"Q: {m.get('query')}")
-            elif m.get("role") == "assistant":
-                qa_lines.append(f"A: {m.get('answer')}")
-        qa_text = "\n\n".join(qa_lines)
-
-        summary_prompt = (
-            "Summarize the following conversation in a concise, technical paragraph (<= 120 words). "
-            "Focus on the key topics discussed, decisions, and important referenced documents.\n\n"
-            f"{qa_text}\n\nSummary:"
-        )
+    # Embed + retrieve before the stream opens, so sources are known up-front
+    # and retrieval errors surface as a normal HTTP error, not a broken stream.
+    query_vector = await embed_query_cached(query_raw)
+    try:
+        docs = await retrieve_docs(query_vector)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error running retrieval: {str(e)}")
+    sources = build_sources(docs)
 
+    async def event_stream():
+        answer_parts = []
         try:
-            summary_text = summarization_call(summary_prompt).strip()
-            if summary_text:
-                # store summary and trim messages to the last TRIM_TO_MESSAGES
-                last_msgs = session["messages"][-TRIM_TO_MESSAGES:] if TRIM_TO_MESSAGES > 0 else []
-                chat_history_col.update_one(
-                    {"user_id": user_id, "session_id": session_id},
-                    {"$set": {"summary": summary_text, "messages": last_msgs, "updated_at": int(time.time())}}
-                )
+            # StrOutputParser streams plain-text deltas straight from Groq
+            async for delta in answer_chain.astream({
+                "context": format_docs(docs),
+                "question": query_raw,
+                "history": format_history(chat_history_pairs),
+            }):
+                if delta:
+                    answer_parts.append(delta)
+                    yield f"data: {json.dumps({'delta': delta})}\n\n"
         except Exception as e:
-            # non-fatal: log and continue
-            print(f"Warning: summarization failed for session {session_id}: {e}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            return
+
+        # Persist only once the full answer exists
+        answer = "".join(answer_parts)
+        assistant_msg = {
+            "role": "assistant",
+            "answer": answer,
+            "sources": sources,
+            "timestamp": int(time.time())
+        }
+        await chat_history_col.update_one(
+            {"user_id": user_id, "session_id": session_id},
+            {"$push": {"messages": assistant_msg,
+                       "chat_history_pairs": {"$each": [[query_raw, answer]],
+                                              "$slice": -(MAX_HISTORY_MESSAGES // 2)}},
+             "$set": {"updated_at": int(time.time())}}
+        )
+        await push_recent_chat(user_id, session_id, session.get("title") or "")
 
-    return {"answer": answer, "sources": list(dict.fromkeys(sources)), "session_id": session_id}
+        # Scheduled here because the title task needs the finished answer;
+        # background tasks run after the response completes.
+        if not session.get("title"):
+            background_tasks.add_task(_gen_title_and_update, user_id, session_id, query_raw, answer)
+        background_tasks.add_task(_maybe_summarize, user_id, session_id)
+
+        yield f"data: {json.dumps({'done': True, 'sources': sources, 'session_id': session_id})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.patch("/chat/rename/{session_id}")
-def rename_chat(session_id: str, req: RenameRequest, user=Depends(get_current_user)):
+async def rename_chat(session_id: str, req: RenameRequest, user=Depends(get_current_user)):
     """
     Rename a session (user-visible title).
     """
@@ -507,59 +867,54 @@ def rename_chat(session_id: str, req: RenameRequest, user=Depends(get_current_us
     new_name = req.new_name.strip()
     if not new_name:
         raise HTTPException(status_code=400, detail="New name must be non-empty")
-    res = chat_history_col.update_one(
+    res = await chat_history_col.update_one(
         {"user_id": user_id, "session_id": session_id},
         {"$set": {"title": new_name, "updated_at": int(time.time())}}
     )
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Session not found")
     # update summary list too
-    user_chat_summary_col.update_one({"user_id": user_id}, {"$pull": {"recent_chats": {"session_id": session_id}}})
-    user_chat_summary_col.update_one(
-        {"user_id": user_id},
-        {"$push": {"recent_chats": {"$each": [{"session_id": session_id, "title": new_name}], "$position": 0, "$slice": MAX_USER_SESSIONS}}},
-        upsert=True
-    )
+    await push_recent_chat(user_id, session_id, new_name)
     return {"message": "Session renamed", "session_id": session_id, "title": new_name}
 
 @app.get("/sessions")
-def list_sessions(user=Depends(get_current_user)):
+async def list_sessions(user=Depends(get_current_user)):
     """
     Return the top N recent sessions for the authenticated user (for UI sidebar).
     """
     user_id = str(user["_id"])
-    doc = user_chat_summary_col.find_one({"user_id": user_id}, {"_id": 0, "recent_chats": 1})
+    doc = await user_chat_summary_col.find_one({"user_id": user_id}, {"_id": 0, "recent_chats": 1})
     recent = doc.get("recent_chats", []) if doc else []
     return {"recent_chats": recent}
 
 @app.get("/chat/{session_id}")
-def get_session(session_id: str, user=Depends(get_current_user)):
+async def get_session(session_id: str, user=Depends(get_current_user)):
     """
     Retrieve full session (title, summary, messages) for UI display.
     """
     user_id = str(user["_id"])
-    session = chat_history_col.find_one({"user_id": user_id, "session_id": session_id}, {"_id": 0})
+    session = await chat_history_col.find_one({"user_id": user_id, "session_id": session_id}, {"_id": 0})
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
 @app.delete("/chat/{session_id}")
-def delete_session(session_id: str, user=Depends(get_current_user)):
+async def delete_session(session_id: str, user=Depends(get_current_user)):
     user_id = str(user["_id"])
-    res = chat_history_col.delete_one({"user_id": user_id, "session_id": session_id})
-    user_chat_summary_col.update_one({"user_id": user_id}, {"$pull": {"recent_chats": {"session_id": session_id}}})
+    res = await chat_history_col.delete_one({"user_id": user_id, "session_id": session_id})
+    await user_chat_summary_col.update_one({"user_id": user_id}, {"$pull": {"recent_chats": {"session_id": session_id}}})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"message": "Session deleted"}
 
 @app.get("/reset_memory")
-def reset_memory(user=Depends(get_current_user)):
+async def reset_memory(user=Depends(get_current_user)):
     """
     Deletes all sessions for this user (use for dev/testing).
     """
     user_id = str(user["_id"])
-    chat_history_col.delete_many({"user_id": user_id})
-    user_chat_summary_col.delete_one({"user_id": user_id})
+    await chat_history_col.delete_many({"user_id": user_id})
+    await user_chat_summary_col.delete_one({"user_id": user_id})
     return {"message": "All sessions cleared for user."}
 
 @app.get("/")
@@ -569,4 +924,14 @@ def root():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("retrieval:app", host="0.0.0.0", port=port, reload=True)
+    reload = os.getenv("RELOAD", "0") == "1"  # RELOAD=1 restores the dev auto-reloader
+    uvicorn.run(
+        "retrieval:app",
+        host="0.0.0.0",
+        port=port,
+        # workers and reload are mutually exclusive in uvicorn
+        workers=1 if reload else int(os.getenv("WEB_CONCURRENCY", 4)),
+        loop="uvloop",       # libuv event loop (uvicorn[standard])
+        http="httptools",    # C HTTP parser (uvicorn[standard])
+        reload=reload,
+    )